@@ -0,0 +1,172 @@
+# standard lib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import socketserver
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict
+
+# 3rd party
+import click
+
+# lib
+from s2_mosaicker import run_job
+
+
+# Shared by the workers of a pool, set by warm_worker()
+worker_barrier = None
+
+
+def warm_worker(gdal_cachemax: int, barrier: multiprocessing.Barrier):
+    """
+    Runs once in each process of the pool. GDAL's block cache lives in the process that reads the files and
+    ImageProcessor keeps the datasets it reads open in that process, so while the pool is alive cached blocks
+    (and the rasterio / numpy imports) carry over to the next job as long as the files are unchanged.
+    """
+    global worker_barrier
+    worker_barrier = barrier
+    os.environ['GDAL_CACHEMAX'] = str(gdal_cachemax)
+    import numpy
+    import rasterio
+
+
+def sweep_worker(timeout: float) -> int:
+    """
+    Close the datasets of files that have been removed (ex: band directories cleared by a pull), so that workers
+    which sat a job out do not keep deleted files open. Waits on the barrier so each worker runs exactly one sweep.
+
+    :return: the pid of the worker
+    """
+    from image_process import ImageProcessor
+    ImageProcessor.close_stale_datasets()
+    worker_barrier.wait(timeout)
+    return os.getpid()
+
+
+def submit_job(socket_path: str, job: Dict) -> Dict:
+    """
+    :param socket_path: The socket the daemon is listening on
+    :param job: The keyword arguments of s2_mosaicker.run_job()
+    :return: the daemon's response: {'status': 'ok', 'output': path} or {'status': 'error', 'error': message}
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(job).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline())
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+            logging.info(f'running job for tile: {job.get("tile_id")}...')
+            response = {'status': 'ok', 'output': self.server.run(job)}
+        except Exception as e:
+            logging.exception('job failed...')
+            response = {'status': 'error', 'error': str(e)}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class MosaicDaemon(socketserver.UnixStreamServer):
+    """
+    A long lived worker that accepts jobs (one json line each) over a local socket. It keeps a connected S3Cli per
+    engine and a process pool warm. Each worker keeps its datasets open, so GDAL's block cache carries over
+    between jobs that read the same (unchanged) files.
+
+    Jobs are run one at a time since they share the band download directories.
+    """
+
+    def __init__(self
+                 , socket_path: str = './tmp/s2_mosaicker.sock'
+                 , max_workers: int = 3
+                 , gdal_cachemax: int = 512 # MB
+                 ):
+        self.socket_path = socket_path
+        self.s3_clis = {}
+        self.max_workers = max_workers
+        self.gdal_cachemax = gdal_cachemax
+        self.create_executor()
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+        super().__init__(socket_path, JobHandler)
+
+    def create_executor(self) -> futures.ProcessPoolExecutor:
+        # Workers start from a clean forkserver rather than a fork of the daemon, which may already have
+        # initialised GDAL (fixing its cache size) and be running the async engine's event loop thread
+        context = multiprocessing.get_context('forkserver')
+        self.barrier = context.Barrier(self.max_workers)
+        self.executor = futures.ProcessPoolExecutor(max_workers=self.max_workers
+                                                    , mp_context=context
+                                                    , initializer=warm_worker
+                                                    , initargs=(self.gdal_cachemax, self.barrier))
+        # Start the workers now rather than on the first job
+        self.sweep_workers()
+        return self.executor
+
+    def sweep_workers(self, timeout: float = 60) -> set:
+        """
+        Run sweep_worker() once in every worker of the pool.
+        :return: the pids of the workers
+        """
+        sweeps = [self.executor.submit(sweep_worker, timeout) for _ in range(self.max_workers)]
+        return {f.result() for f in sweeps}
+
+    def s3_cli(self, engine: str):
+        if engine not in self.s3_clis:
+            from puller import S3Cli, AsyncS3Cli
+            s3_cli = AsyncS3Cli() if engine == 'async' else S3Cli()
+            if engine == 'async':
+                # Keep the event loop and its connections alive across jobs
+                s3_cli.start()
+            s3_cli.connect()
+            self.s3_clis[engine] = s3_cli
+        return self.s3_clis[engine]
+
+    def run(self, job: Dict) -> str:
+        s3_cli = None if job.get('has_pulled') else self.s3_cli(job.get('engine', 'threaded'))
+        try:
+            return run_job(**job, s3_cli=s3_cli, executor=self.executor)
+        except BrokenProcessPool:
+            # A worker died (ex: killed for running out of memory), only this job fails
+            logging.error('a worker died, restarting the process pool...')
+            self.executor.shutdown(wait=False)
+            self.create_executor()
+            raise
+        finally:
+            try:
+                self.sweep_workers()
+            except Exception:
+                logging.exception('failed to close stale datasets in the workers...')
+                self.barrier.reset()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+        if 'async' in self.s3_clis:
+            self.s3_clis['async'].stop()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+@click.command()
+@click.option('--SOCKET', 'socket_path', default='./tmp/s2_mosaicker.sock', help='Socket to listen on. Default is ./tmp/s2_mosaicker.sock')
+@click.option('--MAX_WORKERS', default=3, help='Size of the process pool. Default is 3.')
+@click.option('--GDAL_CACHEMAX', default=512, help='GDAL block cache per worker, in MB. Default is 512.')
+@click.option('--LOGGING_LEVEL', default='INFO', help='Default is INFO.')
+def main(socket_path, max_workers, gdal_cachemax, logging_level):
+    logging.basicConfig(level=logging.getLevelName(logging_level), format='%(message)s')
+
+    with MosaicDaemon(socket_path, max_workers=max_workers, gdal_cachemax=gdal_cachemax) as daemon:
+        logging.info(f'listening on {socket_path}...')
+        daemon.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
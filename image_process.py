@@ -4,24 +4,44 @@ from abc import ABC, abstractmethod
 import os
 from concurrent import futures
 import shutil
-from typing import Dict
+import math
+from typing import Dict, List, Tuple
 
 # 3rd party
 import numpy as np
 
+from affine import Affine
 import rasterio
+import rasterio.io
 from rasterio.windows import Window
+from rasterio import features, warp, windows
 
 
 class ImageProcessor(ABC):
 
+    # Open datasets in this process, keyed by path. Closing a dataset drops its blocks from GDAL's cache, so
+    # they are kept open across windows (and across jobs in a long lived worker, see daemon.py)
+    open_datasets = {}
+
     def __init__(self
                  , img_shape_w :int = 10980
                  , img_shape_h :int = 10980
                  , dest_path: str = './tmp/final/'
                  , red_band_path: str = './tmp/red/'
                  , green_band_path: str = './tmp/green/'
-                 , blue_band_path: str = './tmp/blue/'):
+                 , blue_band_path: str = './tmp/blue/'
+                 , region: List[Dict] = None
+                 , region_crs: str = 'EPSG:4326'
+                 , preview_level: int = 1):
+        """
+        :param region: GeoJSON geometries of the area of interest. When passed only the pixels inside of the
+        region's bounds are read, merged and written, and pixels outside of the geometries are set to 0.
+        :param region_crs: The crs the region is in, it is reprojected to the crs of the tile
+        :param preview_level: Read and write at 1/preview_level resolution (1, 2, 4 or 8). jp2 files hold
+        reduced resolution levels, so decimated reads are far cheaper to decode than full resolution ones.
+        """
+        if preview_level not in (1, 2, 4, 8):
+            raise ValueError(f'preview_level must be one of 1, 2, 4 or 8, not: {preview_level}...')
 
         self.img_shape_w = img_shape_w
         self.img_shape_h = img_shape_h
@@ -29,10 +49,12 @@ class ImageProcessor(ABC):
         self.red_band_path = red_band_path
         self.green_band_path = green_band_path
         self.blue_band_path = blue_band_path
-
+        self.region = region
+        self.region_crs = region_crs
+        self.preview_level = preview_level
 
     @abstractmethod
-    def process(self) -> Dict[str, np.ndarray]:
+    def process(self, executor: futures.Executor = None) -> Dict[str, np.ndarray]:
         raise NotImplemented()
 
     @staticmethod
@@ -40,16 +62,101 @@ class ImageProcessor(ABC):
         _, _, files = next(os.walk(path))
         return len(files)
 
+    @classmethod
+    def open_dataset(cls, path: str) -> rasterio.io.DatasetReader:
+        """
+        :return: an open dataset for path, reused until the file is replaced (ex: re-downloaded)
+        """
+        stat = os.stat(path)
+        version = (stat.st_ino, stat.st_mtime_ns)
+        if path in cls.open_datasets:
+            cached_version, src = cls.open_datasets[path]
+            if cached_version == version:
+                return src
+            src.close()
+
+        src = rasterio.open(path)
+        cls.open_datasets[path] = (version, src)
+        return src
+
+    @classmethod
+    def close_datasets(cls):
+        for _, src in cls.open_datasets.values():
+            src.close()
+        cls.open_datasets.clear()
+
+    @classmethod
+    def close_stale_datasets(cls):
+        for path in list(cls.open_datasets):
+            if not os.path.exists(path):
+                _, src = cls.open_datasets.pop(path)
+                src.close()
+
     @staticmethod
     def get_profile(path) -> Dict:
         with rasterio.open(path) as src:
             profile = src.profile
         return profile
 
+    def region_geometries(self, profile: Dict) -> List[Dict]:
+        return [warp.transform_geom(self.region_crs, profile['crs'], g) for g in self.region]
+
+    def region_window(self, profile: Dict) -> Window:
+        """
+        :param profile: The profile of one of the band images
+        :return: the window of the tile that intersects the region, or the full tile if there is no region.
+        With a preview_level the window is snapped to multiples of it, so each output pixel covers exactly
+        preview_level by preview_level pixels. A partial row or column at the edge of the tile is dropped.
+        """
+        if self.region is None:
+            return self.snap_window(0, self.img_shape_w, 0, self.img_shape_h)
+
+        bounds = [features.bounds(g) for g in self.region_geometries(profile)]
+        left, bottom = min(b[0] for b in bounds), min(b[1] for b in bounds)
+        right, top = max(b[2] for b in bounds), max(b[3] for b in bounds)
+        w = windows.from_bounds(left, bottom, right, top, transform=profile['transform'])
+
+        # Snap outwards to whole pixels and clip to the tile
+        row_start, col_start = max(math.floor(w.row_off), 0), max(math.floor(w.col_off), 0)
+        row_end = min(math.ceil(w.row_off + w.height), self.img_shape_w)
+        col_end = min(math.ceil(w.col_off + w.width), self.img_shape_h)
+        return self.snap_window(row_start, row_end, col_start, col_end)
+
+    def snap_window(self, row_start: int, row_end: int, col_start: int, col_end: int) -> Window:
+        level = self.preview_level
+
+        # Snap outwards to multiples of the preview level, but stay inside of the tile
+        row_start, col_start = row_start - row_start % level, col_start - col_start % level
+        row_end = min(math.ceil(row_end / level) * level, self.img_shape_w - self.img_shape_w % level)
+        col_end = min(math.ceil(col_end / level) * level, self.img_shape_h - self.img_shape_h % level)
+        if row_end <= row_start or col_end <= col_start:
+            raise ValueError('region does not intersect the tile...')
+
+        return Window(col_start, row_start, col_end - col_start, row_end - row_start)
+
+    def output_shape(self, region_window: Window) -> Tuple[int, int]:
+        return region_window.height // self.preview_level, region_window.width // self.preview_level
+
+    def output_transform(self, profile: Dict, region_window: Window) -> Affine:
+        return windows.transform(region_window, profile['transform']) * Affine.scale(self.preview_level)
+
+    def region_mask(self, profile: Dict, region_window: Window) -> np.ndarray:
+        """
+        :return: a 2d boolean array the shape of the output, True where the pixel is outside of the region
+        """
+        return features.geometry_mask(self.region_geometries(profile)
+                                      , out_shape=self.output_shape(region_window)
+                                      , transform=self.output_transform(profile, region_window))
+
     def create_composite(self, arr_map: Dict[str, np.ndarray]):
         # Get geo metadata
         files = os.listdir(self.red_band_path)
         meta = self.get_profile(f'{self.red_band_path}{files[0]}')
+        region_window = self.region_window(meta)
+        height, width = self.output_shape(region_window)
+        meta.update(width=width, height=height, transform=self.output_transform(meta, region_window))
+        if self.region is not None:
+            meta.update(nodata=0)
         meta.update(count=3)
         meta.update(driver='GTiff')
         meta.update(photometric='RGB')
@@ -117,15 +224,19 @@ class WindowImageProcessor(ImageProcessor):
         super().__init__(**kwargs)
         self.merger = merger
         self.window_size_row = window_size_row
-        self.window_size_column = (0, self.img_shape_h)
 
-    def process(self) -> Dict[str, np.array]:
-        with futures.ProcessPoolExecutor(max_workers=3) as executor:
-            future_red = executor.submit(self.window, 'red', f'{self.red_band_path}')
-            future_green = executor.submit(self.window, 'green', f'{self.green_band_path}')
-            future_blue = executor.submit(self.window, 'blue', f'{self.blue_band_path}')
+    def process(self, executor: futures.Executor = None) -> Dict[str, np.array]:
+        """
+        :param executor: A (warm) process pool to window the bands in, by default one is created for this call
+        """
+        if executor is None:
+            with futures.ProcessPoolExecutor(max_workers=3) as executor:
+                return self.process(executor)
+
+        future_red = executor.submit(self.window, 'red', f'{self.red_band_path}')
+        future_green = executor.submit(self.window, 'green', f'{self.green_band_path}')
+        future_blue = executor.submit(self.window, 'blue', f'{self.blue_band_path}')
 
-        executor.shutdown()
         return {
             'red': future_red.result()
             , 'green': future_green.result()
@@ -138,31 +249,45 @@ class WindowImageProcessor(ImageProcessor):
         files = os.listdir(path)
         meta = self.get_profile(f'{path}{files[0]}')
         dtype = meta['dtype']
+        self.close_stale_datasets()
+
+        # Only the rows and columns that intersect the region (the full image by default)
+        region_window = self.region_window(meta)
+        row_start, row_end = region_window.row_off, region_window.row_off + region_window.height
+        mask = self.region_mask(meta, region_window) if self.region is not None else None
+
+        # Windows must line up with the decimated rows
+        level = self.preview_level
+        window_size_row = max(level, self.window_size_row - self.window_size_row % level)
 
         # Create output array
-        output_arr = np.zeros((self.img_shape_w, self.img_shape_h), dtype=dtype)
+        output_arr = np.zeros(self.output_shape(region_window), dtype=dtype)
+        output_width = output_arr.shape[1]
         logging.info(f'computing {band} band median across {num_of_files}'
-                     f' with window size: {self.window_size_row} by {self.img_shape_h}')
+                     f' with window size: {window_size_row} by {region_window.width}'
+                     f' at 1/{level} resolution')
 
         # Iterate down the image in 'windows' - with origin top left
-        for row_idx in range(0, self.img_shape_w, self.window_size_row):
+        for row_idx in range(row_start, row_end, window_size_row):
             logging.info(f'windowing through {band} imgs, at idx: {row_idx} ...')
 
-            # Are we at the last iteration?
-            if (self.img_shape_w - row_idx) > self.window_size_row:
-                multiple_versions_arr = np.zeros((num_of_files, self.window_size_row, self.img_shape_h), dtype=dtype)
-            else:
-                multiple_versions_arr = np.zeros((num_of_files, self.img_shape_w - row_idx, self.img_shape_h), dtype=dtype)
+            # The last window may be smaller
+            window_height = min(window_size_row, row_end - row_idx)
+            output_height = window_height // level
+            multiple_versions_arr = np.zeros((num_of_files, output_height, output_width), dtype=dtype)
 
-            # Store all windows for each in file in multiple_versions_arr
+            # Store all windows for each in file in multiple_versions_arr, decimated reads use the jp2 overviews
             for i, file in enumerate(os.listdir(path)):
-                with rasterio.open(f'{path}{file}') as src:
-                    arr = src.read(1, window=Window.from_slices(
-                        (row_idx, row_idx + self.window_size_row), self.window_size_column))
-                    multiple_versions_arr[i] = arr
+                src = self.open_dataset(f'{path}{file}')
+                arr = src.read(1, window=Window(region_window.col_off, row_idx, region_window.width, window_height)
+                               , out_shape=(output_height, output_width))
+                multiple_versions_arr[i] = arr
 
             # Perform merging
             out = self.merger.merge(multiple_versions_arr)
-            output_arr[row_idx: row_idx + self.window_size_row, :] = out
+            out_idx = (row_idx - row_start) // level
+            if mask is not None:
+                out[mask[out_idx: out_idx + output_height, :]] = 0
+            output_arr[out_idx: out_idx + output_height, :] = out
 
         return output_arr
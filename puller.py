@@ -6,11 +6,19 @@ import logging
 import os
 from concurrent import futures
 import shutil
+import json
+import asyncio
+import threading
+import re
+from urllib.parse import quote, urlencode
+from xml.etree import ElementTree
 
 # 3rd party
 import boto3
 from boto3.s3.transfer import TransferConfig
 import botocore
+from botocore.auth import S3SigV4Auth
+from botocore.awsrequest import AWSRequest
 
 
 class S3Cli:
@@ -24,7 +32,14 @@ class S3Cli:
                  ):
         self.bucket = bucket
 
-    def connect(self):
+    def connect(self, probe: bool = True):
+        """
+        :param probe: Check the bucket is reachable with a HEAD request. Connecting is a no-op once connected,
+        so a long lived S3Cli (ex: the daemon) only pays for the session and probe once.
+        """
+        if self.boto_client is not None:
+            return
+
         # Create one session
         session = boto3.Session()
         session.get_credentials()
@@ -39,6 +54,9 @@ class S3Cli:
                                               multipart_chunksize=(1024 * 1024), # MB
                                               use_threads=True)
 
+        if not probe:
+            return
+
         # Make sure connection is correct
         response = self.boto_client.head_object(Bucket=f'{self.bucket}'
                                                 , RequestPayer='requester'
@@ -48,6 +66,16 @@ class S3Cli:
             logging.fatal(f'cannot establish connection with bucket: {self.bucket}...')
         logging.info(f'successfully established connection with bucket: {self.bucket}...')
 
+    def start(self) -> bool:
+        """
+        The boto3 client is already shared by every call (and thread), so there is nothing to start.
+        :return: whether this call started anything that should be stopped
+        """
+        return False
+
+    def stop(self):
+        pass
+
     @staticmethod
     def flatten(l: List) -> List:
         return [item for sublist in l for item in sublist]
@@ -75,6 +103,22 @@ class S3Cli:
 
         return self.flatten(paths)
 
+    def fetch_object(self, key: str) -> bytes:
+        try:
+            response = self.boto_client.get_object(Bucket=self.bucket, Key=key, RequestPayer='requester')
+        except self.boto_client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read()
+
+    def fetch_objects(self, keys: List[str]) -> Dict[str, bytes]:
+        """
+        :param keys: Small objects to read into memory, ex: tileInfo.json
+        :return: a mapping of key to contents, keys that do not exist are left out
+        """
+        with futures.ThreadPoolExecutor(max_workers=20) as executor:
+            contents = dict(zip(keys, executor.map(self.fetch_object, keys)))
+        return {k: v for k, v in contents.items() if v is not None}
+
     def download_image(self, s3_client, s3_file_path: str, download_path: str):
         logging.info(f'downloading {s3_file_path}...')
         s3_client.download_file(self.bucket
@@ -100,6 +144,298 @@ class S3Cli:
             self.download_image(s3_client, f['Key'], download_path)
 
 
+class AsyncS3Cli(S3Cli):
+    """
+    An asyncio based S3Cli. Listing pages and ranged part-downloads are coroutines sharing a single
+    aiohttp session, so thousands of requests can be in flight over a small pool of connections
+    instead of one OS thread each.
+
+    Requests are signed with botocore (SigV4) and sent with aiohttp. Concurrency is bounded by a
+    semaphore (backpressure) and part bodies are streamed straight to disk with os.pwrite() at their offsets.
+
+    By default each call runs its own event loop and session. start() keeps one loop and session alive
+    (ex: in the daemon) so connections are reused across calls.
+
+    aiohttp is imported lazily, so the threaded engine does not pay for it.
+    """
+
+    S3_NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+
+    # Other
+    credentials = None
+    loop = None
+    http = None
+    semaphore = None
+
+    def __init__(self
+                 , bucket: str = 'sentinel-s2-l1c'
+                 , region: str = 'eu-central-1'
+                 , endpoint_url: str = None
+                 , max_connections: int = 64
+                 , max_concurrency: int = 1000
+                 , part_size: int = 8 * 1024 * 1024 # MB
+                 , listing_depth: int = 3
+                 , max_attempts: int = 5
+                 ):
+        """
+        :param region: The region the bucket lives in, used for signing
+        :param endpoint_url: Override the S3 endpoint (path-style addressing), ex: a local S3 stand-in
+        :param max_connections: The size of the connection pool
+        :param max_concurrency: The maximum number of requests in flight at once
+        :param part_size: The size of each ranged GET
+        :param listing_depth: How many directory levels to fan out on when listing (ex: year/month/day)
+        :param max_attempts: How many times to try a request before giving up
+        """
+        super().__init__(bucket)
+        self.region = region
+        self.endpoint_url = endpoint_url
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.part_size = part_size
+        self.listing_depth = listing_depth
+        self.max_attempts = max_attempts
+
+    def connect(self, probe: bool = True):
+        if self.credentials is not None:
+            return
+
+        session = boto3.Session()
+        self.credentials = session.get_credentials()
+        if self.credentials is None:
+            logging.fatal('no aws credentials found...')
+        if not probe:
+            return
+
+        async def head(http):
+            return await self.request(http, asyncio.Semaphore(1), 'HEAD', 'readme.html')
+
+        status, _, _ = self.run(head)
+        if status != 200:
+            logging.fatal(f'cannot establish connection with bucket: {self.bucket}...')
+        logging.info(f'successfully established connection with bucket: {self.bucket}...')
+
+    def session(self) -> 'aiohttp.ClientSession':
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None, sock_read=60))
+
+    def start(self) -> bool:
+        """
+        Run a long lived event loop (in a background thread), session and concurrency limit that every later
+        call shares, so max_connections and max_concurrency hold across calls (and threads).
+        :return: whether this call started the loop, False if it was already running
+        """
+        if self.loop is not None:
+            return False
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+        async def open_session():
+            return self.session(), asyncio.Semaphore(self.max_concurrency)
+
+        self.http, self.semaphore = asyncio.run_coroutine_threadsafe(open_session(), self.loop).result()
+        return True
+
+    def stop(self):
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.http.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop, self.http, self.semaphore = None, None, None
+
+    def limit(self) -> asyncio.Semaphore:
+        # Must be called on the loop the semaphore is used in
+        return self.semaphore if self.semaphore is not None else asyncio.Semaphore(self.max_concurrency)
+
+    def run(self, func: Callable):
+        """
+        :param func: An async function taking a session, run on the long lived loop if started (thread safe),
+        otherwise in a new loop and session
+        :return: the result of func
+        """
+        if self.loop is not None:
+            return asyncio.run_coroutine_threadsafe(func(self.http), self.loop).result()
+
+        async def run_in_session():
+            async with self.session() as http:
+                return await func(http)
+
+        return asyncio.run(run_in_session())
+
+    def url(self, key: str = '', params: Dict = None) -> str:
+        if self.endpoint_url:
+            url = f'{self.endpoint_url.rstrip("/")}/{self.bucket}/{quote(key, safe="/~")}'
+        else:
+            url = f'https://{self.bucket}.s3.{self.region}.amazonaws.com/{quote(key, safe="/~")}'
+        if params:
+            url = f'{url}?{urlencode(sorted(params.items()), quote_via=quote)}'
+        return url
+
+    def sign(self, method: str, url: str, headers: Dict) -> Dict:
+        request = AWSRequest(method=method, url=url, headers={'x-amz-request-payer': 'requester', **headers})
+        S3SigV4Auth(self.credentials, 's3', self.region).add_auth(request)
+        return dict(request.headers.items())
+
+    async def request(self
+                      , http: 'aiohttp.ClientSession'
+                      , semaphore: asyncio.Semaphore
+                      , method: str
+                      , key: str = ''
+                      , params: Dict = None
+                      , headers: Dict = None
+                      , sink: Callable = None) -> Tuple[int, Dict, bytes]:
+        """
+        :param sink: If passed, body chunks are handed to sink(offset, chunk) as they arrive instead of being buffered
+        :return: the status, response headers and body (empty when a sink is used)
+        """
+        import aiohttp
+        from yarl import URL
+
+        url = self.url(key, params)
+        for attempt in range(1, self.max_attempts + 1):
+            # Sign on every attempt, credentials may have been refreshed
+            signed = self.sign(method, url, headers or {})
+            try:
+                async with semaphore:
+                    async with http.request(method, URL(url, encoded=True), headers=signed) as response:
+                        if response.status >= 500 and attempt < self.max_attempts:
+                            raise aiohttp.ClientResponseError(response.request_info, (), status=response.status)
+                        if sink is None or response.status >= 300:
+                            return response.status, dict(response.headers), await response.read()
+                        offset = 0
+                        async for chunk in response.content.iter_chunked(1024 * 1024):
+                            sink(offset, chunk)
+                            offset += len(chunk)
+                        return response.status, dict(response.headers), b''
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_attempts:
+                    raise
+                logging.debug(f'retrying {method} {key} after: {e}')
+                await asyncio.sleep(0.1 * 2 ** attempt)
+
+    @classmethod
+    def parse_listing(cls, body: bytes) -> Tuple[List[Dict], List[str], str]:
+        """
+        :param body: A ListObjectsV2 xml response
+        :return: the objects (in the same shape as boto3), the common prefixes and the continuation token
+        """
+        ns = cls.S3_NAMESPACE
+        root = ElementTree.fromstring(body)
+        contents = []
+        for c in root.iter(f'{ns}Contents'):
+            contents.append({
+                'Key': c.findtext(f'{ns}Key')
+                , 'LastModified': parser.parse(c.findtext(f'{ns}LastModified'))
+                , 'ETag': c.findtext(f'{ns}ETag')
+                , 'Size': int(c.findtext(f'{ns}Size', '0'))
+                , 'StorageClass': c.findtext(f'{ns}StorageClass')
+            })
+        prefixes = [p.findtext(f'{ns}Prefix') for p in root.iter(f'{ns}CommonPrefixes')]
+        token = None
+        if root.findtext(f'{ns}IsTruncated') == 'true':
+            token = root.findtext(f'{ns}NextContinuationToken')
+        return contents, prefixes, token
+
+    async def list_prefix(self, http, semaphore, prefix: str, delimiter: str = None) -> Tuple[List[List[Dict]], List[str]]:
+        pages, prefixes = [], []
+        token = None
+        while True:
+            params = {'list-type': '2', 'prefix': prefix, 'max-keys': '1000'}
+            if delimiter:
+                params['delimiter'] = delimiter
+            if token:
+                params['continuation-token'] = token
+            status, _, body = await self.request(http, semaphore, 'GET', params=params)
+            if status != 200:
+                raise IOError(f'failed to list {prefix}, status: {status}')
+            contents, common_prefixes, token = self.parse_listing(body)
+            pages.append(contents)
+            prefixes.extend(common_prefixes)
+            if token is None:
+                return pages, prefixes
+
+    async def walk(self, http, semaphore, prefix: str, depth: int) -> List[List[Dict]]:
+        # Pages within a prefix are sequential (continuation tokens), so fan out on sub-directories instead
+        if depth == 0:
+            pages, _ = await self.list_prefix(http, semaphore, prefix)
+            return pages
+        pages, sub_prefixes = await self.list_prefix(http, semaphore, prefix, delimiter='/')
+        children = await asyncio.gather(*[self.walk(http, semaphore, p, depth - 1) for p in sub_prefixes])
+        return pages + self.flatten(children)
+
+    def find_s3_files(self, bucket_prefix: str, filter_func: Callable) -> List[Dict]:
+        logging.info('searching for files in s3...')
+
+        async def find(http):
+            return await self.walk(http, self.limit(), bucket_prefix, self.listing_depth)
+
+        pages = self.run(find)
+        if not any(pages):
+            logging.fatal('no files found...')
+        return self.flatten([filter_func(page) for page in pages if page])
+
+    async def download_parts(self, http, semaphore, s3_file_path: str, download_path: str):
+        logging.info(f'downloading {s3_file_path}...')
+        fd = os.open(download_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            def sink_at(part_offset):
+                return lambda offset, chunk: os.pwrite(fd, chunk, part_offset + offset)
+
+            # The first part tells us the size of the object
+            status, headers, body = await self.request(http, semaphore, 'GET', s3_file_path
+                                                       , headers={'Range': f'bytes=0-{self.part_size - 1}'}
+                                                       , sink=sink_at(0))
+            if status not in (200, 206):
+                raise IOError(f'failed to download {s3_file_path}, status: {status}')
+            if status == 200:
+                return
+
+            size = int(re.match(r'bytes \d+-\d+/(\d+)', headers['Content-Range']).group(1))
+            os.ftruncate(fd, size)
+
+            async def part(start: int):
+                end = min(start + self.part_size, size) - 1
+                status, _, _ = await self.request(http, semaphore, 'GET', s3_file_path
+                                                  , headers={'Range': f'bytes={start}-{end}'}
+                                                  , sink=sink_at(start))
+                if status != 206:
+                    raise IOError(f'failed to download {s3_file_path} part {start}-{end}, status: {status}')
+
+            await asyncio.gather(*[part(start) for start in range(self.part_size, size, self.part_size)])
+        finally:
+            os.close(fd)
+
+    def fetch_objects(self, keys: List[str]) -> Dict[str, bytes]:
+        async def fetch(http):
+            semaphore = self.limit()
+            return await asyncio.gather(*[self.request(http, semaphore, 'GET', k) for k in keys])
+
+        responses = self.run(fetch)
+        return {k: body for k, (status, _, body) in zip(keys, responses) if status == 200}
+
+    def download_images(self
+                        , s3_client
+                        , s3_file_paths: List
+                        , path_to_download: str
+                        , filename_func: Callable):
+        """
+        Same interface as S3Cli.download_images(), s3_client is unused (see run()).
+        """
+        logging.info(f'downloading files to {path_to_download} ...')
+
+        # Clear paths
+        shutil.rmtree(path_to_download, ignore_errors=True)
+        os.makedirs(path_to_download)
+
+        async def download(http):
+            semaphore = self.limit()
+            await asyncio.gather(*[self.download_parts(http, semaphore, f['Key'], f'{path_to_download}{filename_func(f)}')
+                                   for f in s3_file_paths])
+
+        self.run(download)
+
+
 class RGBPuller:
 
     BAND_MAPPING = {
@@ -118,6 +454,10 @@ class RGBPuller:
                  , red_band_path: str = './tmp/red/'
                  , green_band_path: str = './tmp/green/'
                  , blue_band_path: str = './tmp/blue/'
+                 , metadata_path: str = './tmp/metadata/'
+                 , max_cloud_percentage: float = 100
+                 , min_data_coverage: float = 0
+                 , max_scenes: int = None
                  ):
 
         self.s3_cli = s3_cli
@@ -134,9 +474,24 @@ class RGBPuller:
         self.green_band_path = green_band_path
         self.blue_band_path = blue_band_path
 
+        self.metadata_path = metadata_path
+        self.max_cloud_percentage = max_cloud_percentage
+        self.min_data_coverage = min_data_coverage
+        self.max_scenes = max_scenes
+
     def pull_images(self) -> int:
+        # Share one session and concurrency limit between the listing and the three band downloads
+        started = self.s3_cli.start()
+        try:
+            return self.pull()
+        finally:
+            if started:
+                self.s3_cli.stop()
+
+    def pull(self) -> int:
         self.s3_cli.connect()
         s3_paths = self.s3_cli.find_s3_files(self.bucket_prefix, self.filter_s3_files)
+        s3_paths = self.select_scenes(s3_paths, self.load_tile_info(s3_paths))
 
         with futures.ThreadPoolExecutor(max_workers=3) as executor:
             executor.submit(self.s3_cli.download_images
@@ -190,6 +545,80 @@ class RGBPuller:
             return False
         return list(filter(is_valid, l))
 
+    @staticmethod
+    def scene_prefix(file_obj: Dict) -> str:
+        # tiles/utm/lat_band/square/year/month/day/sequence/
+        return '/'.join(file_obj['Key'].split('/')[:8]) + '/'
+
+    def load_tile_info(self, l: List[Dict]) -> Dict[str, Dict]:
+        """
+        :param l: The s3 files to pull
+        :return: a mapping of scene prefix to its tileInfo.json. These are small, so they are cached in metadata_path
+        and only fetched from s3 once.
+        """
+        os.makedirs(self.metadata_path, exist_ok=True)
+
+        def cache_path(prefix: str) -> str:
+            return f'{self.metadata_path}{prefix.strip("/").replace("/", "-")}-tileInfo.json'
+
+        tile_info = {}
+        missing = []
+        for prefix in sorted(set(map(self.scene_prefix, l))):
+            if os.path.exists(cache_path(prefix)):
+                with open(cache_path(prefix)) as f:
+                    tile_info[prefix] = json.load(f)
+            else:
+                missing.append(prefix)
+
+        if missing:
+            logging.info(f'fetching tileInfo.json for {len(missing)} scenes...')
+            fetched = self.s3_cli.fetch_objects([f'{prefix}tileInfo.json' for prefix in missing])
+            for prefix in missing:
+                body = fetched.get(f'{prefix}tileInfo.json')
+                if body is None:
+                    logging.warning(f'no tileInfo.json found for {prefix}...')
+                    continue
+                with open(cache_path(prefix), 'wb') as f:
+                    f.write(body)
+                tile_info[prefix] = json.loads(body)
+
+        return tile_info
+
+    def select_scenes(self, l: List[Dict], tile_info: Dict[str, Dict]) -> List[Dict]:
+        """
+        :param l: The s3 files to pull
+        :param tile_info: A mapping of scene prefix to its tileInfo.json
+        :return: the files of the scenes that pass the cloud and data coverage thresholds. When the same date has been
+        processed more than once (sequence directories /0/, /1/, ...) only the best scene is kept. If max_scenes is set
+        only the best max_scenes are kept.
+
+        Scenes are ranked by: least cloudy, then most data coverage, then latest sequence. Scenes without a
+        tileInfo.json are kept but ranked last.
+        """
+        def rank(prefix: str) -> Tuple[float, float, int]:
+            info = tile_info.get(prefix, {})
+            sequence = int(prefix.split('/')[7])
+            return info.get('cloudyPixelPercentage', 100), -info.get('dataCoveragePercentage', 0), -sequence
+
+        def is_valid(prefix: str) -> bool:
+            if prefix not in tile_info:
+                return True
+            info = tile_info[prefix]
+            return info.get('cloudyPixelPercentage', 0) <= self.max_cloud_percentage \
+                and info.get('dataCoveragePercentage', 100) >= self.min_data_coverage
+
+        scenes = set(map(self.scene_prefix, l))
+
+        # Best scene per date
+        best = {}
+        for prefix in sorted(filter(is_valid, scenes), key=rank):
+            date = '/'.join(prefix.split('/')[4:7])
+            best.setdefault(date, prefix)
+
+        selected = set(sorted(best.values(), key=rank)[:self.max_scenes])
+        logging.info(f'selected {len(selected)} of {len(scenes)} scenes...')
+        return [f for f in l if self.scene_prefix(f) in selected]
+
     def parse_tile_id(self) -> Tuple[str,str,str]:
         if len(self.tile_id) != 4:
             if len(self.tile_id) != 5:
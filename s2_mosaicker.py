@@ -1,44 +1,173 @@
 # standard lib
 import json
 import logging
+import os
+from concurrent import futures
+from typing import Dict, List
 
 # 3rd party
 import click
 
 # lib
-from puller import S3Cli, RGBPuller
-from image_process import WindowImageProcessor, MedianMerger
+# puller (boto3) and image_process (rasterio, numpy) are imported where they are used, so that
+# ex: --has_pulled never imports boto3 and submitting to a daemon imports neither.
 
 
-@click.command()
-@click.argument('TILE_ID', default='10UDV')
-@click.argument('START_DATETIME', default='2019-08-26T02:44:33.000000Z')
-@click.argument('END_DATETIME', default='2019-09-07T18:42:22.000000Z')
-@click.argument('OUTPUT_PATH', default='./tmp/final/')
-@click.option('--LOGGING_LEVEL', default='INFO', help='Default is INFO.')
-@click.option('--COMBINE_METHOD', default='median', help='Method to process images. Default is median.')
-@click.option('--has_pulled', default=False, is_flag=True, help='Pass this flag if you have already pulled images and just wish to process.')
-def main(tile_id, start_datetime, end_datetime, output_path, combine_method, logging_level, has_pulled):
+def check_single_region(ctx: click.Context, param: click.Parameter):
+    other = 'geojson' if param.name == 'bbox' else 'bbox'
+    if ctx.params.get(other) is not None:
+        raise click.BadParameter('--BBOX and --GEOJSON cannot be used together.')
 
-    logging.basicConfig(level=logging.getLevelName(logging_level), format='%(message)s')
 
+def region_from_bbox(ctx: click.Context, param: click.Parameter, value: str) -> List[Dict]:
+    """
+    :param value: 'minx,miny,maxx,maxy'
+    :return: the bbox as a list with a single GeoJSON polygon, or None if not passed
+    """
+    if value is None:
+        return None
+    check_single_region(ctx, param)
+
+    try:
+        minx, miny, maxx, maxy = [float(c) for c in value.split(',')]
+    except ValueError:
+        raise click.BadParameter(f'expected 4 comma separated numbers: minx,miny,maxx,maxy, not: {value}')
+    if minx >= maxx or miny >= maxy:
+        raise click.BadParameter(f'expected minx < maxx and miny < maxy, not: {value}')
+
+    return [{'type': 'Polygon'
+             , 'coordinates': [[(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny)]]}]
+
+
+def region_from_geojson(ctx: click.Context, param: click.Parameter, value: str) -> List[Dict]:
+    """
+    :param value: A path to a GeoJSON geometry, Feature or FeatureCollection
+    :return: a list of GeoJSON geometries, or None if not passed
+    """
+    if value is None:
+        return None
+    check_single_region(ctx, param)
+
+    try:
+        with open(value) as f:
+            obj = json.load(f)
+        if obj['type'] == 'FeatureCollection':
+            return [feature['geometry'] for feature in obj['features']]
+        if obj['type'] == 'Feature':
+            return [obj['geometry']]
+        if 'coordinates' not in obj and 'geometries' not in obj:
+            raise KeyError('coordinates')
+        return [obj]
+    except (ValueError, KeyError, TypeError) as e:
+        raise click.BadParameter(f'{value} is not a GeoJSON geometry, Feature or FeatureCollection: {e}')
+
+
+def run_job(tile_id: str
+            , start_datetime: str
+            , end_datetime: str
+            , output_path: str
+            , combine_method: str = 'median'
+            , engine: str = 'threaded'
+            , max_cloud_percentage: float = 100
+            , min_data_coverage: float = 0
+            , max_scenes: int = None
+            , region: List[Dict] = None
+            , region_crs: str = 'EPSG:4326'
+            , preview_level: int = 1
+            , has_pulled: bool = False
+            , probe: bool = True
+            , s3_cli=None
+            , executor: futures.Executor = None) -> str:
+    """
+    Pull and composite a tile.
+
+    :param probe: Check the bucket is reachable before pulling (a HEAD request)
+    :param s3_cli: A connected S3Cli to reuse, by default one is created for the engine
+    :param executor: A process pool to reuse, by default one is created
+    :return: the path of the composite
+    """
     if not has_pulled:
+        from puller import S3Cli, AsyncS3Cli, RGBPuller
 
         # Find and filter data
-        s3_cli = S3Cli()
-        rgb_puller = RGBPuller(s3_cli, tile_id, start_datetime, end_datetime)
+        if s3_cli is None:
+            s3_cli = AsyncS3Cli() if engine == 'async' else S3Cli()
+        s3_cli.connect(probe=probe)
+        rgb_puller = RGBPuller(s3_cli, tile_id, start_datetime, end_datetime
+                               , max_cloud_percentage=max_cloud_percentage
+                               , min_data_coverage=min_data_coverage
+                               , max_scenes=max_scenes)
         success = rgb_puller.pull_images()
         if success != 0:
             logging.fatal('failed to pull images...')
 
+    from image_process import WindowImageProcessor, MedianMerger
+
     # Manipulate data
     merger = None
     if combine_method == 'median':
         merger = MedianMerger()
 
-    process = WindowImageProcessor(merger=merger, window_size_row=1000, dest_path=output_path)
-    final_imgs = process.process()
+    process = WindowImageProcessor(merger=merger, window_size_row=1000, dest_path=output_path
+                                   , region=region, region_crs=region_crs
+                                   , preview_level=preview_level)
+    final_imgs = process.process(executor)
     process.create_composite(final_imgs)
+    return f'{output_path}combined_image.tiff'
+
+
+@click.command()
+@click.argument('TILE_ID', default='10UDV')
+@click.argument('START_DATETIME', default='2019-08-26T02:44:33.000000Z')
+@click.argument('END_DATETIME', default='2019-09-07T18:42:22.000000Z')
+@click.argument('OUTPUT_PATH', default='./tmp/final/')
+@click.option('--LOGGING_LEVEL', default='INFO', help='Default is INFO.')
+@click.option('--COMBINE_METHOD', default='median', help='Method to process images. Default is median.')
+@click.option('--ENGINE', default='threaded', type=click.Choice(['threaded', 'async']), help='S3 engine used to find and download images. Default is threaded.')
+@click.option('--MAX_CLOUD_PERCENTAGE', default=100.0, help='Skip scenes with a higher cloudy pixel percentage (tileInfo.json). Default is 100.')
+@click.option('--MIN_DATA_COVERAGE', default=0.0, help='Skip scenes with a lower data coverage percentage (tileInfo.json). Default is 0.')
+@click.option('--MAX_SCENES', default=None, type=int, help='Only pull the best N scenes, ranked by cloud and data coverage. Default is all.')
+@click.option('--BBOX', default=None, callback=region_from_bbox, help='Only composite this region: minx,miny,maxx,maxy (in REGION_CRS).')
+@click.option('--GEOJSON', default=None, type=click.Path(exists=True), callback=region_from_geojson, help='Only composite the region in this GeoJSON file (in REGION_CRS).')
+@click.option('--REGION_CRS', default='EPSG:4326', help='CRS of BBOX or GEOJSON. Default is EPSG:4326.')
+@click.option('--preview-level', 'preview_level', default='1', type=click.Choice(['1', '2', '4', '8']), help='Composite at 1/2, 1/4 or 1/8 resolution for a fast preview. Default is 1 (full resolution).')
+@click.option('--DAEMON_SOCKET', default=None, help='Submit the job to a running daemon (see daemon.py) listening on this socket.')
+@click.option('--skip_probe', default=False, is_flag=True, help='Pass this flag to skip checking the bucket is reachable before pulling.')
+@click.option('--has_pulled', default=False, is_flag=True, help='Pass this flag if you have already pulled images and just wish to process.')
+def main(tile_id, start_datetime, end_datetime, output_path, combine_method, logging_level, engine
+         , max_cloud_percentage, min_data_coverage, max_scenes, bbox, geojson, region_crs, preview_level, daemon_socket, skip_probe, has_pulled):
+
+    logging.basicConfig(level=logging.getLevelName(logging_level), format='%(message)s')
+
+    job = {
+        'tile_id': tile_id
+        , 'start_datetime': start_datetime
+        , 'end_datetime': end_datetime
+        , 'output_path': output_path
+        , 'combine_method': combine_method
+        , 'engine': engine
+        , 'max_cloud_percentage': max_cloud_percentage
+        , 'min_data_coverage': min_data_coverage
+        , 'max_scenes': max_scenes
+        , 'region': bbox or geojson
+        , 'region_crs': region_crs
+        , 'preview_level': int(preview_level)
+        , 'has_pulled': has_pulled
+        , 'probe': not skip_probe
+    }
+
+    if daemon_socket is None:
+        run_job(**job)
+        return
+
+    from daemon import submit_job
+
+    # The daemon may not share our working directory
+    job['output_path'] = os.path.join(os.path.abspath(output_path), '')
+    response = submit_job(daemon_socket, job)
+    if response['status'] != 'ok':
+        raise click.ClickException(response['error'])
+    logging.info(f'composite written to {response["output"]}...')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
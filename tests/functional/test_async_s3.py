@@ -0,0 +1,193 @@
+# standard lib
+import asyncio
+import os
+import threading
+from typing import Dict, List
+from xml.sax.saxutils import escape
+
+# 3rd party
+import pytest
+from aiohttp import web
+
+# lib
+from puller import AsyncS3Cli, RGBPuller
+
+
+BUCKET = 'sentinel-s2-l1c'
+
+
+def create_local_s3(objects: Dict[str, bytes], page_size: int = 2, peers: set = None) -> web.Application:
+    """
+    A minimal S3 stand-in: ListObjectsV2 (prefix, delimiter, continuation), HEAD and ranged GETs.
+    Signatures are not verified. The address of every client connection is recorded in peers.
+    """
+    keys = sorted(objects)
+
+    async def list_objects(request):
+        prefix = request.query.get('prefix', '')
+        delimiter = request.query.get('delimiter')
+        start = int(request.query.get('continuation-token', '0'))
+
+        entries = []
+        for k in keys:
+            if not k.startswith(prefix):
+                continue
+            rest = k[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest.split(delimiter)[0] + delimiter
+                if ('prefix', common) not in entries:
+                    entries.append(('prefix', common))
+            else:
+                entries.append(('key', k))
+
+        page = entries[start:start + page_size]
+        truncated = start + page_size < len(entries)
+        body = ['<?xml version="1.0" encoding="UTF-8"?>'
+                , '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                , f'<IsTruncated>{"true" if truncated else "false"}</IsTruncated>']
+        if truncated:
+            body.append(f'<NextContinuationToken>{start + page_size}</NextContinuationToken>')
+        for kind, value in page:
+            if kind == 'key':
+                body.append(f'<Contents><Key>{escape(value)}</Key>'
+                            f'<LastModified>2019-08-27T04:12:22.000Z</LastModified>'
+                            f'<ETag>"etag"</ETag><Size>{len(objects[value])}</Size>'
+                            f'<StorageClass>STANDARD</StorageClass></Contents>')
+            else:
+                body.append(f'<CommonPrefixes><Prefix>{escape(value)}</Prefix></CommonPrefixes>')
+        body.append('</ListBucketResult>')
+        return web.Response(body=''.join(body).encode(), content_type='application/xml')
+
+    async def get_object(request):
+        key = request.match_info['key']
+        if key not in objects:
+            return web.Response(status=404)
+        data = objects[key]
+        if request.method == 'HEAD':
+            return web.Response(headers={'Content-Length': str(len(data))})
+        if 'Range' in request.headers:
+            start, end = request.headers['Range'][len('bytes='):].split('-')
+            start, end = int(start), min(int(end), len(data) - 1)
+            return web.Response(status=206, body=data[start:end + 1]
+                                , headers={'Content-Range': f'bytes {start}-{end}/{len(data)}'})
+        return web.Response(body=data)
+
+    @web.middleware
+    async def record_peer(request, handler):
+        if peers is not None:
+            peers.add(request.transport.get_extra_info('peername'))
+        return await handler(request)
+
+    app = web.Application(middlewares=[record_peer])
+    app.router.add_get(f'/{BUCKET}/', list_objects)
+    app.router.add_route('*', f'/{BUCKET}/{{key:.+}}', get_object)
+    return app
+
+
+@pytest.fixture
+def objects() -> Dict[str, bytes]:
+    objects = {'readme.html': b'<html></html>'}
+    for day in [26, 27, 28]:
+        for band in ['B02.jp2', 'B03.jp2', 'B04.jp2', 'B08.jp2']:
+            objects[f'tiles/10/U/DV/2019/8/{day}/0/{band}'] = os.urandom(10 * 1024 + day)
+    return objects
+
+
+@pytest.fixture
+def peers() -> set:
+    return set()
+
+
+@pytest.fixture
+def local_s3(objects, peers, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'test')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'test')
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(create_local_s3(objects, peers=peers))
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{port}'
+
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+@pytest.fixture
+def s3_cli(local_s3) -> AsyncS3Cli:
+    # Small parts so every file is downloaded in several ranges
+    s3_cli = AsyncS3Cli(endpoint_url=local_s3, part_size=1024, max_connections=4)
+    s3_cli.connect()
+    return s3_cli
+
+
+def filter_rgb(l: List[Dict]) -> List[Dict]:
+    return [f for f in l if f['Key'].split('/')[-1] in RGBPuller.BAND_MAPPING.values()]
+
+
+def test_async_find_s3_files(s3_cli):
+    files = s3_cli.find_s3_files('tiles/10/U/DV/', filter_rgb)
+    keys = sorted(f['Key'] for f in files)
+
+    assert len(keys) == 9
+    assert keys[0] == 'tiles/10/U/DV/2019/8/26/0/B02.jp2'
+    assert files[0]['LastModified'].year == 2019
+
+
+def test_async_find_s3_files_no_fan_out(s3_cli):
+    s3_cli.listing_depth = 0
+    files = s3_cli.find_s3_files('tiles/10/U/DV/', filter_rgb)
+    assert len(files) == 9
+
+
+def test_async_download_images(s3_cli, objects, tmp_path):
+    files = s3_cli.find_s3_files('tiles/10/U/DV/', filter_rgb)
+    red_band = RGBPuller.group_by_band(files, RGBPuller.BAND_MAPPING, 'red')
+
+    s3_cli.download_images(None, red_band, f'{tmp_path}/red/', lambda f: f['Key'].split('/')[6] + '.jp2')
+
+    for f in red_band:
+        with open(f'{tmp_path}/red/{f["Key"].split("/")[6]}.jp2', 'rb') as downloaded:
+            assert downloaded.read() == objects[f['Key']]
+
+
+def test_async_fetch_objects(s3_cli, objects):
+    keys = ['tiles/10/U/DV/2019/8/26/0/B02.jp2', 'tiles/10/U/DV/2019/8/26/0/tileInfo.json']
+    fetched = s3_cli.fetch_objects(keys)
+    assert fetched == {keys[0]: objects[keys[0]]}
+
+
+def test_async_started_reuses_connections(s3_cli, peers, tmp_path):
+    s3_cli.start()
+    peers.clear()
+    try:
+        # Every call shares one pool of keep-alive connections
+        for i in range(3):
+            files = s3_cli.find_s3_files('tiles/10/U/DV/', filter_rgb)
+            s3_cli.download_images(None, files, f'{tmp_path}/{i}/', lambda f: f['Key'].replace('/', '-'))
+        assert len(peers) <= s3_cli.max_connections
+    finally:
+        s3_cli.stop()
+
+
+def test_async_pull_images_shares_connections(s3_cli, objects, peers, tmp_path):
+    # Listing, tileInfo.json fetches and the three band downloads all share one pool
+    peers.clear()
+    puller = RGBPuller(s3_cli, tile_id='10UDV'
+                       , start='2019-08-01T00:00:00.000000Z', end='2019-09-01T00:00:00.000000Z'
+                       , red_band_path=f'{tmp_path}/red/'
+                       , green_band_path=f'{tmp_path}/green/'
+                       , blue_band_path=f'{tmp_path}/blue/'
+                       , metadata_path=f'{tmp_path}/metadata/')
+    assert puller.pull_images() == 0
+
+    assert len(peers) <= s3_cli.max_connections
+    assert s3_cli.loop is None
+    for band in ['red', 'green', 'blue']:
+        assert len(os.listdir(f'{tmp_path}/{band}/')) == 3
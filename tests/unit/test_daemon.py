@@ -0,0 +1,94 @@
+# standard lib
+import os
+import subprocess
+import sys
+import threading
+
+# 3rd party
+import pytest
+
+# lib
+import daemon
+from daemon import MosaicDaemon, submit_job
+
+
+@pytest.fixture
+def mosaic_daemon(tmp_path, monkeypatch):
+    jobs = []
+
+    def run_job(**kwargs):
+        jobs.append(kwargs)
+        if kwargs['tile_id'] == 'bad':
+            raise ValueError('please enter a valid tile_id...')
+        if kwargs['tile_id'] == 'oom':
+            # Kill a worker
+            kwargs['executor'].submit(os._exit, 1).result()
+        # Exercise the pool
+        kwargs['executor'].submit(os.getpid).result()
+        return f'{kwargs["output_path"]}combined_image.tiff'
+
+    monkeypatch.setattr(daemon, 'run_job', run_job)
+
+    server = MosaicDaemon(f'{tmp_path}/s2.sock', max_workers=1, gdal_cachemax=64)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, jobs
+
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_submit_job(mosaic_daemon):
+    server, jobs = mosaic_daemon
+    job = {'tile_id': '10UDV', 'start_datetime': '', 'end_datetime': '', 'output_path': '/tmp/final/', 'has_pulled': True}
+
+    response = submit_job(server.socket_path, job)
+    assert response == {'status': 'ok', 'output': '/tmp/final/combined_image.tiff'}
+
+    # The warm process pool is handed to every job
+    submit_job(server.socket_path, job)
+    assert len(jobs) == 2
+    assert jobs[0]['executor'] is server.executor
+    assert jobs[1]['executor'] is server.executor
+
+
+def test_submit_failing_job(mosaic_daemon):
+    server, _ = mosaic_daemon
+    job = {'tile_id': 'bad', 'start_datetime': '', 'end_datetime': '', 'output_path': '', 'has_pulled': True}
+
+    response = submit_job(server.socket_path, job)
+    assert response['status'] == 'error'
+    assert 'tile_id' in response['error']
+
+
+def test_broken_process_pool_is_restarted(mosaic_daemon):
+    server, _ = mosaic_daemon
+    executor = server.executor
+
+    response = submit_job(server.socket_path, {'tile_id': 'oom', 'output_path': '', 'has_pulled': True})
+    assert response['status'] == 'error'
+    assert server.executor is not executor
+
+    # Later jobs run on the new pool
+    response = submit_job(server.socket_path, {'tile_id': '10UDV', 'output_path': '/tmp/final/', 'has_pulled': True})
+    assert response['status'] == 'ok'
+    # And the new workers are initialised like the first ones
+    assert server.executor.submit(os.getenv, 'GDAL_CACHEMAX').result() == '64'
+
+
+def test_sweep_reaches_every_worker(tmp_path):
+    server = MosaicDaemon(f'{tmp_path}/s2.sock', max_workers=3)
+    try:
+        # Each worker runs exactly one sweep
+        assert len(server.sweep_workers()) == 3
+        assert len(server.sweep_workers()) == 3
+    finally:
+        server.server_close()
+
+
+def test_cli_imports_are_lazy():
+    code = 'import sys, s2_mosaicker, daemon; print(sorted({"boto3", "aiohttp", "rasterio", "numpy"} & set(sys.modules)))'
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    assert out.strip() == '[]'
+
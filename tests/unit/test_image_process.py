@@ -1,4 +1,5 @@
 # standard lib
+import os
 
 # 3rd party
 import pytest
@@ -6,11 +7,18 @@ import numpy as np
 import rasterio
 from rasterio.transform import from_origin
 from rasterio import crs
+from rasterio.windows import Window
 
 # lib
 from image_process import MedianMerger, WindowImageProcessor
 
 
+@pytest.fixture(autouse=True)
+def close_datasets():
+    yield
+    WindowImageProcessor.close_datasets()
+
+
 class TestMedianMerger:
 
     def test_compute_median_even(self):
@@ -129,3 +137,183 @@ def test_windowing(create_img, img, tmp_path):
     assert np.all(arr[2, :] == np.array([3,3,3,3,3]))
     assert np.all(arr[3, :] == np.array([4,5,5,6,6]))
     assert np.all(arr[4, :] == np.array([2,2,2,2,2]))
+
+
+@pytest.fixture()
+def create_georeferenced_img(img, img_2, tmp_path):
+    # 10m pixels, top left corner at (399960, 5000)
+    meta = {
+        'driver': 'GTiff', 'dtype': str(img.dtype)
+        , 'height': img.shape[0], 'width': img.shape[1], 'count': 1
+        , 'crs': crs.CRS.from_epsg(32709), 'transform': from_origin(399960.0, 5000.0, 10.0, 10.0)
+    }
+
+    path = f'{tmp_path}/band/'
+    os.makedirs(path)
+    with rasterio.open(f'{path}img-1.tiff', 'w', **meta) as dst:
+        dst.write(img, 1)
+
+    with rasterio.open(f'{path}img-2.tiff', 'w', **meta) as dst:
+        dst.write(img_2, 1)
+
+    return path
+
+
+def bbox(minx, miny, maxx, maxy):
+    return {'type': 'Polygon', 'coordinates': [[(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny)]]}
+
+
+def test_windowing_region(create_georeferenced_img):
+    # Columns 1-2, rows 1-3
+    process = WindowImageProcessor(merger=MedianMerger(), window_size_row=2, img_shape_w=5, img_shape_h=5
+                                   , region=[bbox(399970.0, 4960.0, 399990.0, 4990.0)], region_crs='EPSG:32709')
+
+    arr = process.window('blue', create_georeferenced_img)
+
+    assert arr.shape == (3, 2)
+    assert np.all(arr[0, :] == np.array([2, 2]))
+    assert np.all(arr[1, :] == np.array([3, 3]))
+    assert np.all(arr[2, :] == np.array([5, 5]))
+
+
+@pytest.fixture()
+def create_utm_img(img, img_2, tmp_path):
+    # 10m pixels in UTM zone 10N (tile 10UDV), top left corner at (499980, 5400000)
+    meta = {
+        'driver': 'GTiff', 'dtype': str(img.dtype)
+        , 'height': img.shape[0], 'width': img.shape[1], 'count': 1
+        , 'crs': crs.CRS.from_epsg(32610), 'transform': from_origin(499980.0, 5400000.0, 10.0, 10.0)
+    }
+
+    path = f'{tmp_path}/utm/'
+    os.makedirs(path)
+    with rasterio.open(f'{path}img-1.tiff', 'w', **meta) as dst:
+        dst.write(img, 1)
+
+    with rasterio.open(f'{path}img-2.tiff', 'w', **meta) as dst:
+        dst.write(img_2, 1)
+
+    return path
+
+
+def test_windowing_region_lon_lat(create_utm_img):
+    # Lon/lat (the default region_crs) of x: 499992 -> 500008, y: 5399962 -> 5399988, ie. columns 1-2, rows 1-3
+    process = WindowImageProcessor(merger=MedianMerger(), window_size_row=2, img_shape_w=5, img_shape_h=5
+                                   , region=[bbox(-123.0001088, 48.7526712, -122.9998912, 48.7529051)])
+
+    profile = process.get_profile(f'{create_utm_img}img-1.tiff')
+    assert process.region_window(profile) == Window(1, 1, 2, 3)
+
+    arr = process.window('blue', create_utm_img)
+    assert arr.shape == (3, 2)
+    assert np.all(arr[0, :] == np.array([2, 2]))
+    assert np.all(arr[1, :] == np.array([3, 3]))
+    assert np.all(arr[2, :] == np.array([5, 5]))
+
+def test_windowing_region_mask(create_georeferenced_img):
+    # Triangle over the top left 3x3 pixels, pixel centers below the diagonal are masked
+    triangle = {'type': 'Polygon', 'coordinates': [[
+        (399960.0, 5000.0), (399985.0, 5000.0), (399960.0, 4975.0), (399960.0, 5000.0)]]}
+    process = WindowImageProcessor(merger=MedianMerger(), window_size_row=2, img_shape_w=5, img_shape_h=5
+                                   , region=[triangle], region_crs='EPSG:32709')
+
+    arr = process.window('blue', create_georeferenced_img)
+
+    assert arr.shape == (3, 3)
+    assert np.all(arr[0, :] == np.array([1, 1, 0]))
+    assert np.all(arr[1, :] == np.array([2, 0, 0]))
+    assert np.all(arr[2, :] == np.array([0, 0, 0]))
+
+
+def test_windowing_region_outside_tile(create_georeferenced_img):
+    process = WindowImageProcessor(merger=MedianMerger(), img_shape_w=5, img_shape_h=5
+                                   , region=[bbox(0.0, 0.0, 10.0, 10.0)], region_crs='EPSG:32709')
+    with pytest.raises(ValueError):
+        process.window('blue', create_georeferenced_img)
+
+
+def test_composite_region(create_georeferenced_img, tmp_path):
+    process = WindowImageProcessor(merger=MedianMerger(), img_shape_w=5, img_shape_h=5
+                                   , red_band_path=create_georeferenced_img
+                                   , green_band_path=create_georeferenced_img
+                                   , blue_band_path=create_georeferenced_img
+                                   , dest_path=f'{tmp_path}/final/'
+                                   , region=[bbox(399970.0, 4960.0, 399990.0, 4990.0)], region_crs='EPSG:32709')
+
+    arr = process.window('red', create_georeferenced_img)
+    process.create_composite({'red': arr, 'green': arr, 'blue': arr})
+
+    with rasterio.open(f'{tmp_path}/final/combined_image.tiff') as composite:
+        assert composite.read().shape == (3, 3, 2)
+        assert composite.transform.c == 399970.0
+        assert composite.transform.f == 4990.0
+
+
+def test_windowing_preview(create_georeferenced_img):
+    process = WindowImageProcessor(merger=MedianMerger(), window_size_row=3, img_shape_w=5, img_shape_h=5
+                                   , preview_level=2)
+
+    arr = process.window('blue', create_georeferenced_img)
+
+    # The last row and column are dropped so every output pixel covers 2x2 pixels.
+    # Window size is snapped to 2 rows, each window is decimated to a single row (nearest)
+    assert arr.shape == (2, 2)
+    assert np.all(arr[0, :] == np.array([2, 2]))
+    assert np.all(arr[1, :] == np.array([5, 6]))
+
+
+def test_windowing_region_preview(create_georeferenced_img):
+    process = WindowImageProcessor(merger=MedianMerger(), window_size_row=2, img_shape_w=5, img_shape_h=5
+                                   , region=[bbox(399970.0, 4960.0, 399990.0, 4990.0)], region_crs='EPSG:32709'
+                                   , preview_level=2)
+
+    # Columns 1-2, rows 1-3 are snapped outwards to columns 0-3, rows 0-3
+    assert process.region_window(process.get_profile(f'{create_georeferenced_img}img-1.tiff')) == Window(0, 0, 4, 4)
+    arr = process.window('blue', create_georeferenced_img)
+    assert arr.shape == (2, 2)
+
+
+def test_composite_preview(create_georeferenced_img, tmp_path):
+    process = WindowImageProcessor(merger=MedianMerger(), img_shape_w=5, img_shape_h=5
+                                   , red_band_path=create_georeferenced_img
+                                   , green_band_path=create_georeferenced_img
+                                   , blue_band_path=create_georeferenced_img
+                                   , dest_path=f'{tmp_path}/final/'
+                                   , preview_level=2)
+
+    arr = process.window('red', create_georeferenced_img)
+    process.create_composite({'red': arr, 'green': arr, 'blue': arr})
+
+    with rasterio.open(f'{tmp_path}/final/combined_image.tiff') as composite:
+        assert composite.read().shape == (3, 2, 2)
+        # Square pixels covering 2x2 full resolution pixels
+        assert composite.res == (20.0, 20.0)
+        assert composite.bounds == (399960.0, 4960.0, 400000.0, 5000.0)
+
+
+def test_invalid_preview_level():
+    with pytest.raises(ValueError):
+        WindowImageProcessor(merger=MedianMerger(), preview_level=3)
+
+
+def test_windowing_reuses_open_datasets(create_georeferenced_img, img):
+    process = WindowImageProcessor(merger=MedianMerger(), window_size_row=2, img_shape_w=5, img_shape_h=5)
+    path = f'{create_georeferenced_img}img-1.tiff'
+
+    process.window('blue', create_georeferenced_img)
+    _, src = WindowImageProcessor.open_datasets[path]
+    process.window('blue', create_georeferenced_img)
+    assert WindowImageProcessor.open_datasets[path][1] is src
+    assert not src.closed
+
+    # A replaced file is reopened, a removed one is closed
+    profile = WindowImageProcessor.get_profile(path)
+    os.remove(path)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(img, 1)
+    os.remove(f'{create_georeferenced_img}img-2.tiff')
+
+    process.window('blue', create_georeferenced_img)
+    assert src.closed
+    assert WindowImageProcessor.open_datasets[path][1] is not src
+    assert f'{create_georeferenced_img}img-2.tiff' not in WindowImageProcessor.open_datasets
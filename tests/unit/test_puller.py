@@ -1,5 +1,6 @@
 # standard lib
-from typing import Dict, Tuple
+import json
+from typing import Dict, List, Tuple
 from datetime import datetime
 from dateutil.tz import tzutc
 
@@ -13,10 +14,11 @@ def create_s3_response(
                          year_month_day: Tuple[int, int, int]
                        , filename: str, id: int
                         , tile_id: Tuple = (8,'DV','A')
+                       , sequence: int = 0
                        ) -> Dict:
 
     year, month, day = year_month_day[0], year_month_day[1], year_month_day[2]
-    filepath = f'tiles/{tile_id[0]}/{tile_id[1]}/{tile_id[2]}/{year}/{month}/{day}/0/{filename}'
+    filepath = f'tiles/{tile_id[0]}/{tile_id[1]}/{tile_id[2]}/{year}/{month}/{day}/{sequence}/{filename}'
     datetime_obj = datetime(year, month, day, 4, 12, 22, tzinfo=tzutc())
     return {
         'Key': filepath
@@ -25,6 +27,20 @@ def create_s3_response(
     }
 
 
+def test_connect_without_probe(monkeypatch):
+    class Client:
+        def head_object(self, **kwargs):
+            raise AssertionError('should not probe')
+
+    monkeypatch.setattr('boto3.client', lambda *args, **kwargs: Client())
+    s3_cli = S3Cli()
+    s3_cli.connect(probe=False)
+    assert isinstance(s3_cli.boto_client, Client)
+
+    # Connecting again is a no-op
+    s3_cli.connect()
+
+
 class TestRBGPuller:
 
     s3_cli = S3Cli()
@@ -106,3 +122,81 @@ class TestRBGPuller:
         assert red_paths[0]['id'] == 2
         assert red_paths[1]['id'] == 6
 
+
+class FakeS3Cli(S3Cli):
+
+    def __init__(self, objects: Dict[str, bytes]):
+        super().__init__()
+        self.objects = objects
+        self.fetched = []
+
+    def fetch_objects(self, keys: List[str]) -> Dict[str, bytes]:
+        self.fetched.extend(keys)
+        return {k: self.objects[k] for k in keys if k in self.objects}
+
+
+def tile_info(cloud: float, coverage: float) -> Dict:
+    return {'cloudyPixelPercentage': cloud, 'dataCoveragePercentage': coverage}
+
+
+class TestSceneSelection:
+
+    start = '2013-08-26T02:44:33.000000Z'
+    end = '2030-08-26T02:44:33.000000Z'
+
+    @pytest.fixture
+    def s3_response(self):
+        return [
+            create_s3_response((2019, 8, 26), 'B02.jp2', 1)
+            , create_s3_response((2019, 8, 26), 'B04.jp2', 2)
+            , create_s3_response((2019, 8, 26), 'B02.jp2', 3, sequence=1)
+            , create_s3_response((2019, 8, 26), 'B04.jp2', 4, sequence=1)
+            , create_s3_response((2019, 8, 28), 'B02.jp2', 5)
+            , create_s3_response((2019, 8, 30), 'B02.jp2', 6)
+            , create_s3_response((2019, 9, 1), 'B02.jp2', 7)
+        ]
+
+    @pytest.fixture
+    def tile_infos(self):
+        return {
+            'tiles/8/DV/A/2019/8/26/0/': tile_info(10, 100)
+            , 'tiles/8/DV/A/2019/8/26/1/': tile_info(10, 100)
+            , 'tiles/8/DV/A/2019/8/28/0/': tile_info(90, 100)
+            , 'tiles/8/DV/A/2019/8/30/0/': tile_info(5, 20)
+        }
+
+    def test_dedupe_keeps_latest_sequence(self, s3_response, tile_infos):
+        puller = RGBPuller(S3Cli(), tile_id="8DVA", start=self.start, end=self.end)
+        selected = [f['id'] for f in puller.select_scenes(s3_response, tile_infos)]
+        assert selected == [3, 4, 5, 6, 7]
+
+    def test_dedupe_keeps_least_cloudy(self, s3_response, tile_infos):
+        tile_infos['tiles/8/DV/A/2019/8/26/0/'] = tile_info(2, 100)
+        puller = RGBPuller(S3Cli(), tile_id="8DVA", start=self.start, end=self.end)
+        selected = [f['id'] for f in puller.select_scenes(s3_response, tile_infos)]
+        assert selected == [1, 2, 5, 6, 7]
+
+    def test_filter_cloud_and_coverage(self, s3_response, tile_infos):
+        puller = RGBPuller(S3Cli(), tile_id="8DVA", start=self.start, end=self.end
+                           , max_cloud_percentage=50, min_data_coverage=50)
+        selected = [f['id'] for f in puller.select_scenes(s3_response, tile_infos)]
+        # Scenes without metadata are kept
+        assert selected == [3, 4, 7]
+
+    def test_max_scenes(self, s3_response, tile_infos):
+        puller = RGBPuller(S3Cli(), tile_id="8DVA", start=self.start, end=self.end, max_scenes=2)
+        selected = [f['id'] for f in puller.select_scenes(s3_response, tile_infos)]
+        assert selected == [3, 4, 6]
+
+    def test_load_tile_info_is_cached(self, s3_response, tile_infos, tmp_path):
+        objects = {f'{k}tileInfo.json': json.dumps(v).encode() for k, v in tile_infos.items()}
+        s3_cli = FakeS3Cli(objects)
+        puller = RGBPuller(s3_cli, tile_id="8DVA", start=self.start, end=self.end
+                           , metadata_path=f'{tmp_path}/metadata/')
+
+        assert puller.load_tile_info(s3_response) == tile_infos
+        assert len(s3_cli.fetched) == 5
+
+        # Only the scene without a tileInfo.json is requested again
+        assert puller.load_tile_info(s3_response) == tile_infos
+        assert s3_cli.fetched[5:] == ['tiles/8/DV/A/2019/9/1/0/tileInfo.json']
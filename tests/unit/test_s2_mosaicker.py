@@ -0,0 +1,75 @@
+# standard lib
+import json
+
+# 3rd party
+import pytest
+from click.testing import CliRunner
+
+# lib
+import s2_mosaicker
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    jobs = []
+    monkeypatch.setattr(s2_mosaicker, 'run_job', lambda **kwargs: jobs.append(kwargs))
+    return jobs
+
+
+@pytest.fixture
+def geojson_path(tmp_path):
+    path = f'{tmp_path}/region.geojson'
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {}
+             , 'geometry': {'type': 'Point', 'coordinates': [-123.0, 49.2]}}
+        ]}, f)
+    return path
+
+
+def test_bbox_region(jobs):
+    result = CliRunner().invoke(s2_mosaicker.main, ['--BBOX', '-123.1,49.2,-123.0,49.3'])
+    assert result.exit_code == 0
+
+    region = jobs[0]['region']
+    assert region[0]['type'] == 'Polygon'
+    assert region[0]['coordinates'][0][0] == (-123.1, 49.2)
+    assert region[0]['coordinates'][0][2] == (-123.0, 49.3)
+
+
+def test_no_region(jobs):
+    result = CliRunner().invoke(s2_mosaicker.main, [])
+    assert result.exit_code == 0
+    assert jobs[0]['region'] is None
+
+
+@pytest.mark.parametrize('bbox', ['1,2,3', '1,2,3,a', '3,2,1,4'])
+def test_malformed_bbox(jobs, bbox):
+    result = CliRunner().invoke(s2_mosaicker.main, ['--BBOX', bbox])
+    assert result.exit_code == 2
+    assert 'Invalid value for' in result.output
+    assert jobs == []
+
+
+def test_geojson_region(jobs, geojson_path):
+    result = CliRunner().invoke(s2_mosaicker.main, ['--GEOJSON', geojson_path])
+    assert result.exit_code == 0
+    assert jobs[0]['region'] == [{'type': 'Point', 'coordinates': [-123.0, 49.2]}]
+
+
+def test_malformed_geojson(jobs, tmp_path):
+    path = f'{tmp_path}/region.geojson'
+    with open(path, 'w') as f:
+        f.write('{"type": "Feature"}')
+
+    result = CliRunner().invoke(s2_mosaicker.main, ['--GEOJSON', path])
+    assert result.exit_code == 2
+    assert jobs == []
+
+
+def test_bbox_and_geojson(jobs, geojson_path):
+    for args in [['--BBOX', '1,2,3,4', '--GEOJSON', geojson_path], ['--GEOJSON', geojson_path, '--BBOX', '1,2,3,4']]:
+        result = CliRunner().invoke(s2_mosaicker.main, args)
+        assert result.exit_code == 2
+        assert 'cannot be used together' in result.output
+    assert jobs == []